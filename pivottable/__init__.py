@@ -1,3 +1,4 @@
 from pivottable import (
-    PivotTable, GroupBy, Sum
+    PivotTable, Aggregation, GroupBy, Sum, Count, Min, Max, CountDistinct,
+    ApproxCountDistinct, Quantile
 )
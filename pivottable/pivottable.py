@@ -52,20 +52,98 @@ if version_info<(2,5):
 else:
     from operator import itemgetter, attrgetter
 
-from itertools import ifilter
+from itertools import ifilter, groupby, islice
+from array import array
+from tempfile import TemporaryFile
+from shutil import copyfileobj
+from math import log
+import os
+import struct
 
-__all__ = ['PivotTable', 'Agregation', 'GroupBy', 'Sum']
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from heapq import merge
+except ImportError: # we are in python < 2.6
+    from heapq import heapify, heappop, heapreplace
+    def merge(*iterables):
+        h = []
+        for itnum, it in enumerate(map(iter, iterables)):
+            try:
+                next = it.next
+                h.append([next(), itnum, next])
+            except StopIteration:
+                pass
+        heapify(h)
+        while 1:
+            try:
+                while 1:
+                    v, itnum, next = s = h[0]
+                    yield v
+                    s[0] = next()
+                    heapreplace(h, s)
+            except StopIteration:
+                heappop(h)
+            except IndexError:
+                return
+
+try:
+    from hashlib import md5
+except ImportError: # we are in python < 2.5
+    from md5 import md5
+
+def bit_length(n):
+    try:
+        return n.bit_length()
+    except AttributeError: # we are in python < 2.7
+        l = 0
+        while n:
+            n >>= 1
+            l += 1
+        return l
+
+__all__ = ['PivotTable', 'Aggregation', 'GroupBy', 'Sum', 'Count', 'Min',
+           'Max', 'CountDistinct', 'ApproxCountDistinct', 'Quantile']
+
+# snapshot files start with the magic, the fingerprint of the pivot
+# definition and the lengths of the data version and the pickled metadata.
+# Then come the columns of codes, as little endian 4 byte ints, the
+# numeric metrics, as little endian 8 byte doubles whatever the platform,
+# and the pickled metrics, one pickle per cell
+SNAPSHOT_MAGIC = 'PVTSNAP1'
+SNAPSHOT_HEADER = '<8s16sII'
+SNAPSHOT_CODE = 'i'
+SNAPSHOT_NUMBER = 'd'
+SNAPSHOT_CHUNK = 1000 # cells packed or unpacked at a time
 
 class PivotTableError(Exception):
     pass
 
 class Aggregation(object):
 
-    values = []
+    sql = None # name of the equivalent SQL aggregate, see materialize_sql()
+
+    def __init__(self):
+        self.values = []
 
     def append(self, value):
         self.values.append(value)
 
+    def merge(self, other):
+        """Fold the values accumulated by another instance of the same
+        aggregation into this one. Used to roll up materialized cells"""
+        self.values.extend(other.values)
+        return self
+
+    def combine(self, value):
+        """Fold a value that was already aggregated elsewhere (e.g. by the SQL
+        aggregate named in the sql attribute) into this instance"""
+        if value is not None:
+            self.append(value)
+
     def __call__(self):
         raise(NotImplementedError)
 
@@ -73,9 +151,211 @@ class GroupBy(Aggregation):
     pass
 
 class Sum(Aggregation):
+    """Addition of the values (None is ignored)"""
+
+    sql = 'SUM'
+
+    def __call__(self):
+        return sum([v for v in self.values if v is not None])
+
+class Count(Aggregation):
+    """Number of values (None is not counted)"""
+
+    sql = 'COUNT'
+
+    def __init__(self):
+        self.count = 0
+
+    def append(self, value):
+        if value is not None:
+            self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+        return self
+
+    def combine(self, value):
+        self.count += value
+
+    def __call__(self):
+        return self.count
+
+class Min(Aggregation):
+    """Smallest value (None is ignored)"""
+
+    sql = 'MIN'
+
+    def __init__(self):
+        self.value = None
+
+    def append(self, value):
+        if value is not None and (self.value is None or value < self.value):
+            self.value = value
+
+    def merge(self, other):
+        self.append(other.value)
+        return self
+
+    def __call__(self):
+        return self.value
+
+class Max(Min):
+    """Largest value (None is ignored)"""
+
+    sql = 'MAX'
+
+    def append(self, value):
+        if value is not None and (self.value is None or value > self.value):
+            self.value = value
+
+class CountDistinct(Aggregation):
+    """Exact number of different values (None is not counted). Memory grows
+    with the number of different values, not with the number of rows"""
+
+    def __init__(self):
+        self.values = set()
+
+    def append(self, value):
+        if value is not None:
+            self.values.add(value)
+
+    def merge(self, other):
+        self.values.update(other.values)
+        return self
 
     def __call__(self):
-        return sum(self.values)
+        return len(self.values)
+
+class ApproxCountDistinct(Aggregation):
+    """HyperLogLog estimate of the number of different values (None is not
+    counted). Every instance keeps 2**precision one byte registers no matter
+    how many values it sees; the standard error is about
+    1.04/sqrt(2**precision), 1.6% with the default precision. Subclass it and
+    override precision (4 to 16, that is 26% to 0.4% standard error) to
+    trade memory for accuracy"""
+
+    precision = 12
+
+    def __init__(self):
+        if not 4 <= self.precision <= 16:
+            raise(PivotTableError(u'HyperLogLog precision must be between 4 '
+                                   'and 16'))
+        self.registers = array('B', [0]*(1 << self.precision))
+
+    def append(self, value):
+        if value is None:
+            return
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif isinstance(value, float):
+            # str() keeps only 12 significant digits of a float
+            value = repr(value)
+        # python's hash() is not stable between processes or platforms: use
+        # the first 64 bits of a md5 digest instead
+        x = struct.unpack('<Q', md5(str(value)).digest()[:8])[0]
+        tail = 64-self.precision
+        j = x >> tail
+        rank = tail-bit_length(x & ((1 << tail)-1))+1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def merge(self, other):
+        if len(other.registers) != len(self.registers):
+            raise(PivotTableError(u'Cannot merge HyperLogLog registers of '
+                                   'different precision'))
+        r = self.registers
+        for j, rank in enumerate(other.registers):
+            if rank > r[j]:
+                r[j] = rank
+        return self
+
+    def __call__(self):
+        m = len(self.registers)
+        # bias correction constants from the HyperLogLog paper: the formula
+        # only holds from 128 registers on
+        alpha = {16:0.673, 32:0.697, 64:0.709}.get(m, 0.7213/(1+1.079/m))
+        e = alpha*m*m/sum([2.0**-rank for rank in self.registers])
+        zeros = self.registers.count(0)
+        if e <= 2.5*m and zeros:
+            # small range correction (linear counting)
+            e = m*log(float(m)/zeros)
+        return int(round(e))
+
+class Quantile(Aggregation):
+    """Approximate quantile (the median by default) using a KLL sketch: a
+    stack of compactors where items at level h stand for 2**h values. Memory
+    is bounded by about 3*k items per instance and the rank error is around
+    1.65% with the default k. While fewer than k values are seen the result
+    is exact (nearest rank, None is ignored). Subclass it and override
+    quantile (between 0 and 1) to get another one, e.g. quantile = 0.95"""
+
+    quantile = 0.5
+    k = 200
+
+    def __init__(self):
+        self.compactors = [[]]
+        # alternate the half that survives compaction at every level
+        self.offsets = [0]
+        self.size = 0
+
+    def _capacity(self, height):
+        depth = len(self.compactors)-height-1
+        return int(self.k*(2.0/3)**depth)+2
+
+    def _grow(self):
+        self.compactors.append([])
+        self.offsets.append(0)
+
+    def _compress(self):
+        for h in range(len(self.compactors)):
+            c = self.compactors[h]
+            if len(c) >= self._capacity(h):
+                if h+1 == len(self.compactors):
+                    self._grow()
+                c.sort()
+                # an odd item out stays where it is
+                keep = c[len(c)//2*2:]
+                self.compactors[h+1].extend(
+                    c[self.offsets[h]:len(c)-len(keep):2])
+                self.offsets[h] = 1-self.offsets[h]
+                self.compactors[h] = keep
+                self.size = sum([len(n) for n in self.compactors])
+                break
+
+    def append(self, value):
+        if value is None:
+            return
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= sum([self._capacity(h) for h in \
+                             range(len(self.compactors))]):
+            self._compress()
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for h, c in enumerate(other.compactors):
+            self.compactors[h].extend(c)
+        self.size = sum([len(n) for n in self.compactors])
+        while self.size >= sum([self._capacity(h) for h in \
+                                range(len(self.compactors))]):
+            self._compress()
+        return self
+
+    def __call__(self):
+        weighted = []
+        for h, c in enumerate(self.compactors):
+            weighted.extend([(v, 1 << h) for v in c])
+        if not weighted:
+            return None
+        weighted.sort()
+        rank = self.quantile*sum([w for v, w in weighted])
+        seen = 0
+        for v, w in weighted:
+            seen += w
+            if seen >= rank:
+                return v
+        return weighted[-1][0]
 
 class PivotTable(object):
 
@@ -86,12 +366,25 @@ class PivotTable(object):
     calculate_totals = False
     subtotal_label = None
     total_label = None
+    memory_limit = None # max cells held in memory, see materialize()
+    where = None # {attr: predicate} for GroupBy attrs or the xaxis
+    xaxis_range = None # (lo, hi), both included, None for no bound
+    xaxis_presorted = False # rows are sorted by xaxis, see _selected()
+    sql_quote = '"' # quotes identifiers in materialize_sql(), '`' for MySQL
 
 
     _sheaders = set()
     _xaxis = None
     _iod = OrderedDict() # inner ordered dict
     _gk = []
+    _cube = None # materialized cells, see materialize()
+    _cube_runs = [] # cells spilled to disk
+    _cube_xaxis = None
+    _cube_groupby = []
+    _cube_metrics = []
+    _cube_conditions = (None, {}) # xaxis_range and where the cells obey
+    _cube_codes = [] # {value: code} per GroupBy attr plus one for xaxis
+    _cube_values = [] # code -> value lists, same order as _cube_codes
 
     def __xaxis_get(self):
         """The name of the object attribute that will be use to pivot values.
@@ -211,9 +504,8 @@ class PivotTable(object):
         self._iod = OrderedDict([(i,None) for i in self._headers])
         return self._headers
 
-    @property
-    def result(self):
-        # let's start building the final result
+    def _start_result(self):
+        """Start the final result with the formatted header row"""
         self._r = []
         h_ = OrderedDict()
         # boilerplate to make sure the headers are up2date
@@ -223,7 +515,39 @@ class PivotTable(object):
             except AttributeError:
                 h_["c%d" % h[0]] = self._dummy_formatter(h[1])
         self._r.append(h_)
-        del h_
+
+    def coresult(self, chunk_size=1000):
+        """Generator version of result for materialized tables: it
+        generates lists of up to chunk_size rows, the header row first.
+        While the cells are indexed and sorted a list (usually empty) is
+        generated every chunk_size cells, so that a cooperative scheduler can
+        run other tasks in between even before the first row is ready"""
+        if self._cube is None:
+            raise(PivotTableError(u'Only materialized tables can be read '
+                                   'cooperatively'))
+        self._start_result()
+        rows = []
+        for row in self._cube_result(chunk_size):
+            if row is None:
+                yield rows
+                rows = []
+                continue
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    @property
+    def result(self):
+        if self.memory_limit and self._cube is None:
+            # the plain path below holds every row in memory
+            raise(PivotTableError(u'memory_limit only applies to materialized '
+                                   'tables: call materialize() first'))
+        self._start_result()
+        if self._cube is not None:
+            return self._cube_result()
         ngk = [i for i in self._notgroupby_getter()] # 'not group by' keys
         # for every row we need to build the 'k_' that will represent an
         # unique row in out final table. 
@@ -231,7 +555,9 @@ class PivotTable(object):
             kd = attrgetter(*self.yaxis_order)
         except TypeError:
             kd = o_attrgetter(*self.yaxis_order)
-        k_ = map(kd, self.rows)
+        # rows left out by where or xaxis_range are dropped before anything
+        rows = list(self._selected(self.rows))
+        k_ = map(kd, rows)
         # bonus point: we order the data
         # we don't sort the list in place because we might have more than one
         # object with the same key and because of that we have to set(list)
@@ -252,7 +578,7 @@ class PivotTable(object):
         # for every ordered value
         for i in k_:
             # we get the list of appearances of a same key
-            for j in enumerate(ifilter(lambda x: kd(x)==i, self.rows)):
+            for j in enumerate(ifilter(lambda x: kd(x)==i, rows)):
                 # we need to build an iod for every metric for this key...
                 for k in enumerate(ngk):
                     # ... but only one time. we use cn as the index of the 
@@ -288,9 +614,704 @@ class PivotTable(object):
         self._sheaders = set()
         if self.xaxis is None:
             raise(PivotTableError(u'You need to define X-axis'))
-        for i in self.rows:
+        if self._cube is not None:
+            if self.xaxis != self._cube_xaxis:
+                raise(PivotTableError(u'X-axis changed since the cube was '
+                                       'materialized'))
+            self._check_cube_conditions()
+            self._sheaders = set(self._cube_values[-1])
+            return
+        for i in self._selected(self.rows):
             self._sheaders.add(getattr(i, self.xaxis))
 
+    def _conditions(self):
+        """Return an (attr, predicate) pair for every condition in where plus
+        one for xaxis_range, if defined, which always goes first"""
+        conditions = []
+        if self.xaxis_range is not None:
+            lo, hi = self.xaxis_range
+            def in_range(x):
+                return (lo is None or lo <= x) and (hi is None or x <= hi)
+            conditions.append((self.xaxis, in_range))
+        if self.where:
+            try:
+                gbk = self._groupby_getter()
+            except AttributeError:
+                raise(PivotTableError(u'You need to define Y-axis'))
+            for attr, predicate in self.where.items():
+                if attr != self.xaxis and attr not in gbk:
+                    raise(PivotTableError(u'where conditions can only refer '
+                                           'to the X-axis or GroupBy attrs'))
+                conditions.append((attr, predicate))
+        return conditions
+
+    def _check_cube_conditions(self):
+        """Complain if where or xaxis_range changed since the cube was
+        started: its cells would not obey them"""
+        if (self.xaxis_range, dict(self.where or {})) != \
+           self._cube_conditions:
+            raise(PivotTableError(u'where or xaxis_range changed since the '
+                                   'cube was materialized'))
+
+    def _selected(self, objects):
+        """Return the objects that pass every condition in where and
+        xaxis_range. Only the attrs in the conditions are read from the
+        objects being discarded. If the objects are in a list sorted by xaxis
+        (see xaxis_presorted) the ones outside xaxis_range are not even
+        looked at"""
+        conditions = self._conditions()
+        if self.xaxis_range is not None and self.xaxis_presorted and \
+           hasattr(objects, '__getitem__'):
+            objects = self._xaxis_slice(objects)
+            conditions = conditions[1:]
+        if not conditions:
+            return objects
+        conditions = [(attrgetter(a), p) for a, p in conditions]
+        def selected(obj):
+            for g, p in conditions:
+                if not p(g(obj)):
+                    return False
+            return True
+        return ifilter(selected, objects)
+
+    def _xaxis_slice(self, objects):
+        """Bisect a list of objects sorted by xaxis to the slice inside
+        xaxis_range"""
+        lo, hi = self.xaxis_range
+        xd = attrgetter(self.xaxis)
+        i, j = 0, len(objects)
+        if lo is not None:
+            # first object not below lo
+            a, b = 0, j
+            while a < b:
+                c = (a+b)//2
+                if xd(objects[c]) < lo:
+                    a = c+1
+                else:
+                    b = c
+            i = a
+        if hi is not None:
+            # first object above hi
+            a, b = i, j
+            while a < b:
+                c = (a+b)//2
+                if hi < xd(objects[c]):
+                    b = c
+                else:
+                    a = c+1
+            j = a
+        return objects[i:j]
+
+    def materialize(self):
+        """Aggregate rows once at the finest granularity (every GroupBy attr
+        plus the xaxis) and keep the accumulators. From then on headers and
+        result are answered from these cells without looking at rows: a new
+        yaxis_order is a re-sort of the cells, leaving a GroupBy attr out of
+        yaxis_order rolls the cells up by merging their accumulators and
+        xaxis_sort only affects the headers. If memory_limit is set, every
+        time that many cells are held in memory they are spilled to a
+        temporary file as a sorted run. Call it again whenever rows or yaxis
+        change"""
+        self._start_cube()
+        self._add_cells(self._records(self.rows))
+
+    def feed(self, iterable):
+        """Aggregate the objects in iterable into the materialized cells,
+        starting them if the table was not materialized yet. The objects are
+        not kept, so rows do not need to hold the whole data set: they can
+        arrive in as many batches as needed"""
+        if self._cube is None:
+            self._start_cube()
+        self._add_cells(self._records(iterable))
+
+    def cofeed(self, iterable, chunk_size=1000):
+        """Generator version of feed(): after aggregating every chunk_size
+        objects it yields how many objects were aggregated so far. This lets
+        a cooperative scheduler (an event loop driving generators) run other
+        tasks in between chunks while a big table is being built"""
+        if self._cube is None:
+            self._start_cube()
+        it = iter(iterable)
+        n = 0
+        while 1:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                return
+            self._add_cells(self._records(chunk))
+            n += len(chunk)
+            yield n
+
+    def materialize_sql(self, connection, source, params=None):
+        """Like materialize() but the aggregation is pushed down to a
+        database: xaxis and the GroupBy attrs become the GROUP BY of a single
+        query over source (a table name or a SELECT statement, which may use
+        params as placeholders) run through the DB-API connection, and every
+        metric is computed by the SQL aggregate named in the 'sql' attribute
+        of its Aggregation (Sum, Count, Min and Max). Only the aggregated rows
+        travel to python. Values come back as the database driver returns
+        them: e.g. sqlite3 returns dates as strings unless asked otherwise.
+        Identifiers are quoted with sql_quote, ANSI double quotes by default:
+        set it to a backtick for MySQL unless it runs in ANSI_QUOTES mode.
+        Without params the query is executed on its own, so drivers using
+        the format or pyformat paramstyle do not expand % in source"""
+        gbk, metrics = self._definition()
+        query = self._compile_sql(source, gbk, metrics)
+        n = len(gbk)
+        # where and xaxis_range only refer to GROUP BY columns: checking them
+        # on the aggregated rows gives the same cells
+        conditions = []
+        for a, p in self._conditions():
+            if a in gbk:
+                conditions.append((gbk.index(a), p))
+            else:
+                conditions.append((n, p))
+        def records():
+            while 1:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                for r in rows:
+                    for c, p in conditions:
+                        if not p(r[c]):
+                            break
+                    else:
+                        yield tuple(r[:n]), r[n], r[n+1:]
+        cursor = connection.cursor()
+        try:
+            if params is None:
+                cursor.execute(query)
+            else:
+                cursor.execute(query, params)
+            self._start_cube()
+            self._add_cells(records(), partial=True)
+        finally:
+            cursor.close()
+
+    def _compile_sql(self, source, gbk, metrics):
+        """Translate the pivot definition into an aggregate query: GroupBy
+        attrs and the xaxis go first, one aggregate per metric after them"""
+        q = self.sql_quote
+        def quote(attr):
+            return q+attr.replace(q, q+q)+q
+        aggregates = []
+        for m in metrics:
+            sql = m['aggr'].sql
+            if sql is None:
+                raise(PivotTableError(u'%s cannot be computed by the database'
+                                      % m['aggr'].__name__))
+            aggregates.append('%s(%s)' % (sql, quote(m['attr'])))
+        keys = [quote(a) for a in gbk+[self.xaxis]]
+        words = source.split(None, 1)
+        if not words:
+            raise(PivotTableError(u'You need to define the source table or '
+                                  u'query'))
+        if words[0].lower() in ('select', 'with'):
+            source = '(%s) pivot_source' % source
+        # keys always holds at least the xaxis
+        query = 'SELECT %s FROM %s GROUP BY %s' % (
+            ', '.join(keys+aggregates), source, ', '.join(keys))
+        # let the database hand the groups over in yaxis_order
+        order = [quote(a) for a in self.yaxis_order or [] if a in gbk]
+        query += ' ORDER BY %s' % ', '.join(
+            order+[k for k in keys if k not in order])
+        return query
+
+    def _definition(self):
+        """Return the GroupBy attrs and the metrics defined in yaxis"""
+        if self.xaxis is None:
+            raise(PivotTableError(u'You need to define X-axis'))
+        try:
+            gbk = self._groupby_getter()
+            metrics = [m for m in self.yaxis if m['aggr']!=GroupBy]
+        except AttributeError:
+            raise(PivotTableError(u'You need to define Y-axis'))
+        return gbk, metrics
+
+    def _start_cube(self):
+        """Drop any materialized cell and get ready to aggregate the current
+        pivot definition"""
+        gbk, metrics = self._definition()
+        # complain about wrong conditions before dropping anything
+        self._conditions()
+        self.dematerialize()
+        self._cube = {}
+        self._cube_xaxis = self.xaxis
+        self._cube_groupby = gbk
+        self._cube_metrics = [(m['attr'], m['aggr']) for m in metrics]
+        self._cube_conditions = (self.xaxis_range, dict(self.where or {}))
+        self._cube_codes = [{} for n in range(len(gbk)+1)]
+        self._cube_values = [[] for n in range(len(gbk)+1)]
+
+    def _records(self, objects):
+        """Yield a (key, xaxis value, metric values) record per object"""
+        self._check_cube_conditions()
+        kd = self._tuple_getter(self._cube_groupby)
+        xd = attrgetter(self._cube_xaxis)
+        ngk = [attr for attr, aggr in self._cube_metrics]
+        for i in self._selected(objects):
+            yield kd(i), xd(i), [getattr(i, a) for a in ngk]
+
+    def _add_cells(self, records, partial=False):
+        """Aggregate (key, xaxis value, metric values) records into the
+        materialized cells. When partial is True the values are already
+        aggregated and are combined into the cells instead of appended. Keys
+        and xaxis values are dictionary encoded: cells are addressed by small
+        integer codes and every distinct value is kept only once"""
+        aggrs = [aggr for attr, aggr in self._cube_metrics]
+        cube = self._cube
+        codes, decoded = self._cube_codes, self._cube_values
+        dims = range(len(codes)-1)
+        xcodes, xvalues = codes[-1], decoded[-1]
+        for k, x, values in records:
+            key = []
+            for n in dims:
+                try:
+                    key.append(codes[n][k[n]])
+                except KeyError:
+                    codes[n][k[n]] = len(decoded[n])
+                    key.append(len(decoded[n]))
+                    decoded[n].append(k[n])
+            try:
+                x = xcodes[x]
+            except KeyError:
+                xcodes[x] = len(xvalues)
+                xvalues.append(x)
+                x = xcodes[x]
+            k = (tuple(key), x)
+            try:
+                cell = cube[k]
+            except KeyError:
+                if self.memory_limit and len(cube) >= self.memory_limit:
+                    self._cube_runs.append(self._spill(cube))
+                    cube = self._cube = {}
+                cell = cube[k] = [a() for a in aggrs]
+            if partial:
+                for a, v in zip(cell, values):
+                    a.combine(v)
+            else:
+                for a, v in zip(cell, values):
+                    a.append(v)
+
+    def save_snapshot(self, path, version):
+        """Write the materialized cells to path so that other processes can
+        load_snapshot() them instead of aggregating rows again. version
+        identifies the data the cells were built from (e.g. the date of the
+        nightly load) and is stored along with a fingerprint of the pivot
+        definition and xaxis_range. Tables with where conditions cannot be
+        saved: predicates are code that no fingerprint can tell apart.
+        Metrics whose Aggregation has an SQL equivalent (and so can be
+        rebuilt from its value) are stored as arrays of doubles when their
+        values are numbers, the other ones are pickled. Cells are streamed
+        to a temporary file per column, so spilled cubes are never read back
+        into memory"""
+        if self._cube is None:
+            raise(PivotTableError(u'There are no materialized cells to save'))
+        if self.where:
+            raise(PivotTableError(u'Tables with where conditions cannot be '
+                                   'saved as snapshots'))
+        gbk, metrics = self._definition()
+        if self.xaxis != self._cube_xaxis or gbk != self._cube_groupby or \
+           [(m['attr'], m['aggr']) for m in metrics] != self._cube_metrics:
+            raise(PivotTableError(u'Pivot definition changed since the cube '
+                                   'was materialized'))
+        self._check_cube_conditions()
+        # first pass: find out which metrics can be stored as numbers
+        sql = [j for j in range(len(metrics))
+               if metrics[j]['aggr'].sql is not None]
+        types = [set() for m in metrics]
+        largest = [0]*len(metrics)
+        ncells = 0
+        for k, cell in self._snapshot_cells():
+            ncells += 1
+            for j in sql:
+                v = cell[j]()
+                if v is not None:
+                    types[j].add(type(v))
+                    if isinstance(v, (int, long)):
+                        largest[j] = max(largest[j], abs(v))
+        columns = []
+        for j in range(len(metrics)):
+            kind = 'p'
+            if types[j] == set([float]):
+                kind = 'd'
+            elif types[j] and not types[j]-set([int, long]) and \
+                 largest[j] <= 2**53:
+                # integers that survive the trip through a double
+                kind = 'i'
+            columns.append(kind)
+        numeric = [j for j, kind in enumerate(columns) if kind != 'p']
+        pickled = [j for j, kind in enumerate(columns) if kind == 'p']
+        # second pass: a column of codes per GroupBy attr and another one
+        # for the xaxis, then the numeric and the pickled metrics
+        dims = len(self._cube_values)
+        formats = [SNAPSHOT_CODE]*dims + [SNAPSHOT_NUMBER]*len(numeric)
+        files = [TemporaryFile() for n in range(len(formats)+len(pickled))]
+        try:
+            buffers = [[] for t in formats]
+            def flush():
+                for f, t, b in zip(files, formats, buffers):
+                    f.write(struct.pack('<%d%s' % (len(b), t), *b))
+                    del b[:]
+            for (k, x), cell in self._snapshot_cells():
+                for b, c in zip(buffers, k+(x,)):
+                    b.append(c)
+                for b, j in zip(buffers[dims:], numeric):
+                    v = cell[j]()
+                    # missing values (e.g. Min of nothing) are stored as NaN
+                    if v is None:
+                        v = float('nan')
+                    b.append(v)
+                for f, j in zip(files[len(formats):], pickled):
+                    pickle.dump(cell[j], f, pickle.HIGHEST_PROTOCOL)
+                if len(buffers[0]) >= SNAPSHOT_CHUNK:
+                    flush()
+            flush()
+            meta = {'values':self._cube_values, 'ncells':ncells,
+                    'columns':columns,
+                    'pickled':[f.tell() for f in files[len(formats):]]}
+            meta = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+            version = self._encode_version(version)
+            # readers must never see a half written snapshot
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            f = open(tmp, 'wb')
+            try:
+                try:
+                    f.write(struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC,
+                                        self._fingerprint(), len(version),
+                                        len(meta)))
+                    f.write(version)
+                    f.write(meta)
+                    for column in files:
+                        column.seek(0)
+                        copyfileobj(column, f)
+                finally:
+                    f.close()
+                try:
+                    os.rename(tmp, path)
+                except OSError: # windows does not replace existing files
+                    os.remove(path)
+                    os.rename(tmp, path)
+            except:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        finally:
+            for f in files:
+                f.close()
+
+    def load_snapshot(self, path, version):
+        """Replace the materialized cells with the ones written by
+        save_snapshot(). Cells are rebuilt SNAPSHOT_CHUNK at a time and
+        spilled like materialize() does once memory_limit is reached, which
+        is still much cheaper than aggregating the rows again. Return False,
+        leaving the table untouched, if the snapshot belongs to another
+        pivot definition, xaxis_range or data version. A truncated or
+        corrupt file raises PivotTableError and leaves the table untouched
+        as well"""
+        if self.where:
+            raise(PivotTableError(u'Tables with where conditions cannot be '
+                                   'loaded from snapshots'))
+        gbk, metrics = self._definition()
+        f = open(path, 'rb')
+        try:
+            def read(size):
+                data = f.read(size)
+                if len(data) != size:
+                    raise(PivotTableError(u'%s is truncated' % path))
+                return data
+            off = struct.calcsize(SNAPSHOT_HEADER)
+            header = f.read(off)
+            if len(header) != off or header[:8] != SNAPSHOT_MAGIC:
+                raise(PivotTableError(u'%s is not a pivot table snapshot' %
+                                      path))
+            magic, fingerprint, vlen, mlen = struct.unpack(SNAPSHOT_HEADER,
+                                                           header)
+            if fingerprint != self._fingerprint() or \
+               read(vlen) != self._encode_version(version):
+                return False
+            meta = pickle.loads(read(mlen))
+            off += vlen+mlen
+        finally:
+            f.close()
+        n = meta['ncells']
+        kinds = meta['columns']
+        numeric = [j for j, kind in enumerate(kinds) if kind != 'p']
+        pickled = [j for j, kind in enumerate(kinds) if kind == 'p']
+        # key and xaxis codes first, then the numeric and pickled columns
+        dims = len(meta['values'])
+        formats = [SNAPSHOT_CODE]*dims + [SNAPSHOT_NUMBER]*len(numeric)
+        offsets = []
+        for t in formats:
+            offsets.append(off)
+            off += struct.calcsize('<%d%s' % (n, t))
+        for size in meta['pickled']:
+            offsets.append(off)
+            off += size
+        # check before reading any cell that the file holds every one of
+        # them and nothing more
+        if os.path.getsize(path) != off:
+            raise(PivotTableError(u'%s is truncated' % path))
+        aggrs = [m['aggr'] for m in metrics]
+        cube, runs = {}, []
+        files = []
+        try:
+            try:
+                for off in offsets:
+                    f = open(path, 'rb')
+                    files.append(f)
+                    f.seek(off)
+                for i in xrange(0, n, SNAPSHOT_CHUNK):
+                    c = min(SNAPSHOT_CHUNK, n-i)
+                    arrays = []
+                    for f, t in zip(files, formats):
+                        fmt = '<%d%s' % (c, t)
+                        arrays.append(struct.unpack(fmt,
+                                      f.read(struct.calcsize(fmt))))
+                    for f in files[len(formats):]:
+                        arrays.append([pickle.load(f) for r in xrange(c)])
+                    kcodes, xcodes = arrays[:dims-1], arrays[dims-1]
+                    values = dict(zip(numeric+pickled, arrays[dims:]))
+                    for r in xrange(c):
+                        cell = []
+                        for j, kind in enumerate(kinds):
+                            v = values[j][r]
+                            if kind == 'p':
+                                cell.append(v)
+                                continue
+                            a = aggrs[j]()
+                            if v == v: # NaN stands for a missing value
+                                if kind == 'i':
+                                    v = int(v)
+                                a.combine(v)
+                            cell.append(a)
+                        if self.memory_limit and \
+                           len(cube) >= self.memory_limit:
+                            runs.append(self._spill(cube))
+                            cube = {}
+                        k = tuple([codes[r] for codes in kcodes])
+                        cube[(k, xcodes[r])] = cell
+            finally:
+                for f in files:
+                    f.close()
+        except:
+            for f in runs:
+                f.close()
+            raise
+        self._start_cube()
+        self._cube, self._cube_runs = cube, runs
+        self._cube_values = meta['values']
+        self._cube_codes = [dict([(v, c) for c, v in enumerate(values)])
+                            for values in self._cube_values]
+        return True
+
+    def _snapshot_cells(self):
+        """Iterate over every materialized cell, merging the spilled runs"""
+        if self._cube_runs:
+            return self._merge_runs(self._cube_runs, self._cube)
+        return self._cube.iteritems()
+
+    @staticmethod
+    def _encode_version(version):
+        """Snapshot versions are stored as utf-8 text"""
+        if isinstance(version, unicode):
+            return version.encode('utf-8')
+        return str(version)
+
+    def _fingerprint(self):
+        """Digest of everything that shapes the materialized cells"""
+        gbk, metrics = self._definition()
+        def text(value):
+            return unicode(value).encode('utf-8')
+        definition = (text(self.xaxis), [text(a) for a in gbk],
+                      [(text(m['attr']), m['aggr'].__module__,
+                        m['aggr'].__name__) for m in metrics],
+                      self.xaxis_range)
+        return md5(repr(definition)).digest()
+
+    def dematerialize(self):
+        """Drop the materialized cells: result will be built from rows
+        again"""
+        for f in self._cube_runs:
+            f.close()
+        self._cube = None
+        self._cube_runs = []
+        self._cube_codes = []
+        self._cube_values = []
+
+    def _cube_result(self, chunk_size=None):
+        """Build the result out of the materialized cells, merging the ones
+        that end up with the same key when yaxis_order does not name every
+        GroupBy attr. Rows are generated as they are requested, see
+        _cube_rows() for chunk_size"""
+        try:
+            idx = [self._cube_groupby.index(i) for i in self.yaxis_order]
+        except ValueError:
+            raise(PivotTableError(u'Y-axis order refers to an attr that was '
+                                   'not materialized as GroupBy'))
+        metrics = [m for m in self.yaxis if m['aggr']!=GroupBy]
+        try:
+            pos = [self._cube_metrics.index((m['attr'], m['aggr']))
+                   for m in metrics]
+        except ValueError:
+            raise(PivotTableError(u'Y-axis defines a metric that was not '
+                                   'materialized'))
+        return self._cube_rows(idx, metrics, pos, chunk_size)
+
+    def _cube_rows(self, idx, metrics, pos, chunk_size=None):
+        """Generate the header row and then, for every yaxis_order key in
+        order, a row per metric. If chunk_size is given None is generated as
+        well every chunk_size cells indexed or sorted, letting coresult()
+        hand control back before the first row is ready"""
+        yield self._r[0].values()
+        rollup = sorted(idx) != range(len(self._cube_groupby))
+        # codes are given in order of arrival: replace them with their rank so
+        # that sorting keys of codes sorts the values they stand for
+        ranks, ordered = [], []
+        for values in self._cube_values[:-1]:
+            o = range(len(values))
+            o.sort(key=values.__getitem__)
+            r = [0]*len(o)
+            for rank, code in enumerate(o):
+                r[code] = rank
+            ranks.append(r)
+            ordered.append([values[code] for code in o])
+            if chunk_size:
+                yield None
+        xvalues = self._cube_values[-1]
+        if self._cube_runs:
+            chunks = []
+            for pause in self._sort_keys(self._cube, chunk_size, chunks):
+                if chunk_size:
+                    yield pause
+            items = self._merge_runs(self._cube_runs, self._cube,
+                                     self._in_order(chunks))
+        else:
+            items = self._cube.iteritems()
+        # index the cells by the yaxis_order key and the xaxis value
+        cells = {}
+        runs = []
+        for i, ((k, x), cell) in enumerate(items):
+            if chunk_size and i and not i % chunk_size:
+                yield None
+            k = (tuple([ranks[n][k[n]] for n in idx]), x)
+            if k in cells:
+                # only happens when rolling up
+                for a, p in zip(cells[k], pos):
+                    a.merge(cell[p])
+                continue
+            if self.memory_limit and len(cells) >= self.memory_limit:
+                runs.append(self._spill(cells))
+                cells = {}
+            if rollup:
+                cells[k] = [m['aggr']().merge(cell[p])
+                            for m, p in zip(metrics, pos)]
+            else:
+                cells[k] = cell
+        chunks = []
+        for pause in self._sort_keys(cells, chunk_size, chunks):
+            if chunk_size:
+                yield pause
+        if runs:
+            records = self._merge_runs(runs, cells, self._in_order(chunks))
+        else:
+            records = ((k, cells[k]) for k in self._in_order(chunks))
+        if rollup:
+            # merged cells only hold the requested metrics, in yaxis order
+            pos = range(len(metrics))
+        # every yaxis_order key arrives together with all of its xaxis values
+        for k, group in groupby(records, lambda n: n[0][0]):
+            group = [(xvalues[x], cell) for (k_, x), cell in group]
+            k = [ordered[n][rank] for n, rank in zip(idx, k)]
+            for m, p in zip(metrics, pos):
+                r = self._iod.copy()
+                r['metric'] = m.get('label', m['attr'])
+                for l, v in zip(self.yaxis_order, k):
+                    r[l] = v
+                m_format = m.get('format', self._dummy_formatter)
+                for x, cell in group:
+                    r[x] = m_format(cell[p]())
+                yield r.values()
+
+    @staticmethod
+    def _spill(cells):
+        """Write the cells, sorted by key, to a temporary file (a run) and
+        return it"""
+        f = TemporaryFile()
+        keys = cells.keys()
+        keys.sort()
+        for k in keys:
+            pickle.dump((k, cells[k]), f, pickle.HIGHEST_PROTOCOL)
+        return f
+
+    @staticmethod
+    def _read_run(f, n):
+        """Yield every cell in a run, tagged with the run number so that
+        cells sharing a key never get compared"""
+        f.seek(0)
+        load = pickle.Unpickler(f).load
+        while 1:
+            try:
+                k, cell = load()
+            except EOFError:
+                return
+            yield k, n, cell
+
+    @staticmethod
+    def _sort_keys(cells, chunk_size, chunks):
+        """Sort the keys of cells into chunks, chunk_size keys at a time or
+        all at once without chunk_size, generating None after every chunk.
+        See _in_order()"""
+        keys = cells.keys()
+        step = chunk_size or len(keys) or 1
+        for i in xrange(0, len(keys), step):
+            chunk = keys[i:i+step]
+            chunk.sort()
+            chunks.append(chunk)
+            yield None
+
+    @staticmethod
+    def _in_order(chunks):
+        """Iterate over the keys sorted by _sort_keys()"""
+        if len(chunks) == 1:
+            return chunks[0]
+        return merge(*chunks)
+
+    def _merge_runs(self, runs, cells, keys=None):
+        """k-way merge of the spilled runs plus the cells still in memory,
+        merging the cells that share a key. The in-memory cells go last so
+        they are merged into a copy that came from disk, never modified.
+        keys, if given, iterates over the keys of cells in order"""
+        its = [self._read_run(f, n) for n, f in enumerate(runs)]
+        if keys is None:
+            keys = sorted(cells)
+        def tagged(n):
+            for k in keys:
+                yield k, n, cells[k]
+        its.append(tagged(len(runs)))
+        last = acc = None
+        for k, n, cell in merge(*its):
+            if acc is not None and k == last:
+                for a, b in zip(acc, cell):
+                    a.merge(b)
+            else:
+                if acc is not None:
+                    yield last, acc
+                last, acc = k, cell
+        if acc is not None:
+            yield last, acc
+
+    @staticmethod
+    def _tuple_getter(items):
+        """Like attrgetter but always return a tuple, no matter how many
+        items were requested"""
+        if len(items) == 1:
+            g = attrgetter(items[0])
+            return lambda obj: (g(obj),)
+        try:
+            return attrgetter(*items)
+        except TypeError:
+            return o_attrgetter(*items)
+
     @staticmethod
     def _dummy_formatter(value):
         """Return the same value as submitted in unicode"""
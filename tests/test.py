@@ -1,11 +1,16 @@
 # -*- coding: UTF-8 -*-
+import os
 import datetime
+import sqlite3
+import tempfile
 from random import shuffle
 from nose.tools import eq_, raises, assert_raises
 
 from pivottable import (
-PivotTable, GroupBy, Sum
+PivotTable, GroupBy, Sum, Count, Min, Max, CountDistinct,
+ApproxCountDistinct, Quantile
 )
+from pivottable import pivottable
 from pivottable.pivottable import PivotTableError
 
 class TestError(Exception):
@@ -57,6 +62,20 @@ def percent(value):
 def year_month(value):
     return value.strftime("%b-%y")
 
+# shared by the tests of materialized tables
+SALES = [GenericObject(**{'city':city, 'office':office, 'month':month,
+                          'sales':sales, 'rate':rate, 'customer':customer})
+         for city, office, month, sales, rate, customer in [
+             (u'West City', u'1st', 2, 245, 0.5, u'Goku'),
+             (u'North City', u'2nd', 1, 34, 0.25, u'Vegeta'),
+             (u'West City', u'2nd', 1, 12, 0.5, u'Bulma'),
+             (u'North City', u'1st', 1, 6, 0.75, u'Goku'),
+             (u'South City', u'1st', 3, 9011, 0.5, u'Krilin'),
+             (u'North City', u'2nd', 1, 20, 0.25, u'Goku'),
+             (u'West City', u'1st', 2, 5, 0.5, u'Bulma'),
+             (u'North City', u'1st', 3, None, 1.0, u'Gohan'),
+             (u'South City', u'1st', 4, 1.5, 0.5, u'Krilin')]]
+
 class TestPivot_A(object):
 
     pt = PivotTable()
@@ -504,3 +523,608 @@ class TestPivot_D(object):
             {'attr':u'distro', 'label':u'Distro', 'aggr':GroupBy})
         self.pt.headers
         all_ = [a for a in self.pt.result]
+
+class TestPivot_E(object):
+
+    pt = PivotTable()
+    pt.rows = [
+        GenericObject(**{'city':u'North City', 'office':u'1st Office',
+                         'month':datetime.date(2010,1,1), 'sales':34}),
+        GenericObject(**{'city':u'North City', 'office':u'1st Office',
+                         'month':datetime.date(2010,1,1), 'sales':6}),
+        GenericObject(**{'city':u'North City', 'office':u'2nd Office',
+                         'month':datetime.date(2010,2,1), 'sales':555}),
+        GenericObject(**{'city':u'West City', 'office':u'1st Office',
+                         'month':datetime.date(2010,1,1), 'sales':2344}),
+        GenericObject(**{'city':u'West City', 'office':u'1st Office',
+                         'month':datetime.date(2010,2,1), 'sales':245})
+    ]
+    pt.xaxis = "month"
+    pt.xaxis_format = year_month
+    pt.yaxis = [
+        {'attr':'city', 'label':u'City', 'aggr':GroupBy},
+        {'attr':'office', 'label':u'Office', 'aggr':GroupBy},
+        {'attr':'sales', 'label':u'Sales', 'aggr':Sum}]
+    pt.yaxis_order = ['city', 'office']
+
+    def test_EA_materialize(self):
+        self.pt.materialize()
+        # from now on rows are not needed anymore
+        self.pt.rows = []
+        eq_([a for a in self.pt.result], [
+            ['city', 'office', u'metric', 'Jan-10', 'Feb-10'],
+            [u'North City', u'1st Office', u'Sales', u'40', None],
+            [u'North City', u'2nd Office', u'Sales', None, u'555'],
+            [u'West City', u'1st Office', u'Sales', u'2344', u'245']])
+
+    def test_EB_reorder(self):
+        self.pt.yaxis_order = ['office', 'city']
+        self.pt.xaxis_sort = True
+        eq_([a for a in self.pt.result], [
+            ['office', 'city', u'metric', 'Jan-10', 'Feb-10'],
+            [u'1st Office', u'North City', u'Sales', u'40', None],
+            [u'1st Office', u'West City', u'Sales', u'2344', u'245'],
+            [u'2nd Office', u'North City', u'Sales', None, u'555']])
+
+    def test_EC_rollup(self):
+        self.pt.yaxis_order = ['city']
+        eq_([a for a in self.pt.result], [
+            ['city', u'metric', 'office', 'Jan-10', 'Feb-10'],
+            [u'North City', u'Sales', None, u'40', u'555'],
+            [u'West City', u'Sales', None, u'2344', u'245']])
+        # rolling up must not touch the materialized cells
+        self.pt.yaxis_order = ['office']
+        eq_([a for a in self.pt.result][1:], [
+            [u'1st Office', u'Sales', None, u'2384', u'245'],
+            [u'2nd Office', u'Sales', None, None, u'555']])
+
+    def test_ED_not_materialized(self):
+        self.pt.yaxis_order = ['month']
+        assert_raises(PivotTableError, getattr, self.pt, 'result')
+        self.pt.yaxis_order = ['city', 'office']
+        self.pt.dematerialize()
+        eq_([a for a in self.pt.result], [
+            ['city', 'office', u'metric']])
+
+class P95(Quantile):
+    quantile = 0.95
+
+class HLL4(ApproxCountDistinct):
+    precision = 4
+
+class HLL3(ApproxCountDistinct):
+    precision = 3
+
+class TestAggregation(object):
+
+    def test_FA_count_distinct(self):
+        a, b = CountDistinct(), CountDistinct()
+        for i in [u'x', u'y', None, u'x']:
+            a.append(i)
+        for i in [u'y', u'z']:
+            b.append(i)
+        eq_(a(), 2)
+        eq_(a.merge(b)(), 3)
+
+    def test_FB_approx_count_distinct(self):
+        a, b = ApproxCountDistinct(), ApproxCountDistinct()
+        for i in xrange(20000):
+            a.append(i)
+            b.append(i+10000)
+        eq_(len(a.registers), 4096)
+        assert abs(a()-20000) < 20000*0.05, a()
+        assert abs(a.merge(b)()-30000) < 30000*0.05, a()
+        eq_(len(a.registers), 4096)
+        c = ApproxCountDistinct()
+        for i in [u'Brazil', 'Brazil', u'Italy', None]:
+            c.append(i)
+        eq_(c(), 2)
+        # floats that only differ beyond the 12th significant digit
+        d, e = ApproxCountDistinct(), CountDistinct()
+        for i in xrange(1000):
+            d.append(1.0+i*1e-13)
+            e.append(1.0+i*1e-13)
+        eq_(e(), 1000)
+        assert abs(d()-1000) < 1000*0.05, d()
+
+    def test_FE_approx_count_distinct_precision(self):
+        assert_raises(PivotTableError, HLL3)
+        # 16 registers: the estimate is unbiased but the error is about 26%
+        errors = []
+        for n in range(20):
+            a = HLL4()
+            for i in xrange(n*100000, n*100000+20000):
+                a.append(i)
+            errors.append(a()/20000.0-1)
+        assert abs(sum(errors)/len(errors)) < 0.1, errors
+
+    def test_FC_quantile(self):
+        a = Quantile()
+        for i in [5, 1, None, 3, 2, 4]:
+            a.append(i)
+        eq_(a(), 3)
+        eq_(Quantile()(), None)
+        values = range(20000)
+        shuffle(values)
+        a, b = P95(), P95()
+        for i in values[:10000]:
+            a.append(i)
+        for i in values[10000:]:
+            b.append(i)
+        assert a.size < 3*a.k, a.size
+        assert abs(a.merge(b)()-19000) < 20000*0.02, a()
+        assert a.size < 3*a.k, a.size
+
+    def test_FD_materialize(self):
+        pt = PivotTable()
+        pt.rows = SALES
+        pt.xaxis = "month"
+        pt.yaxis = [
+            {'attr':'city', 'label':u'City', 'aggr':GroupBy},
+            {'attr':'customer', 'label':u'Customers', 'aggr':CountDistinct},
+            {'attr':'sales', 'label':u'Median', 'aggr':Quantile}]
+        pt.yaxis_order = ['city']
+        pt.materialize()
+        eq_([a for a in pt.result], [
+            ['city', u'metric', u'1', u'2', u'3', u'4'],
+            [u'North City', u'Customers', u'2', None, u'1', None],
+            [u'North City', u'Median', u'20', None, None, None],
+            [u'South City', u'Customers', None, None, u'1', u'1'],
+            [u'South City', u'Median', None, None, u'9011', u'1.5'],
+            [u'West City', u'Customers', u'1', u'2', None, None],
+            [u'West City', u'Median', u'12', u'5', None, None]])
+        # roll up every city into a single row
+        pt.yaxis_order = []
+        eq_([a for a in pt.result][1:], [
+            [u'Customers', None, u'3', u'2', u'2', u'1'],
+            [u'Median', None, u'12', u'5', u'9011', u'1.5']])
+
+class TestPivot_G(object):
+
+    pt = PivotTable()
+    pt.rows = SALES
+    pt.xaxis = "month"
+    pt.yaxis = [
+        {'attr':'city', 'label':u'City', 'aggr':GroupBy},
+        {'attr':'office', 'label':u'Office', 'aggr':GroupBy},
+        {'attr':'sales', 'label':u'Sales', 'aggr':Sum},
+        {'attr':'customer', 'label':u'Customers', 'aggr':CountDistinct}]
+    pt.memory_limit = 2
+
+    reference = PivotTable()
+    reference.rows = SALES
+    reference.xaxis = "month"
+    reference.yaxis = pt.yaxis
+
+    def test_GA_spill(self):
+        self.pt.materialize()
+        self.reference.materialize()
+        assert self.pt._cube_runs
+        spilled = []
+        def spill(cells):
+            spilled.append(len(cells))
+            return PivotTable._spill(cells)
+        # re-ordering and rolling up must be bounded by memory_limit too
+        self.pt._spill = spill
+        for order in [['city', 'office'], ['office', 'city'], ['city'],
+                      ['office'], []]:
+            del spilled[:]
+            self.pt.yaxis_order = self.reference.yaxis_order = order
+            eq_([a for a in self.pt.result],
+                [a for a in self.reference.result])
+            assert spilled, order
+            assert max(spilled) <= self.pt.memory_limit, spilled
+        del self.pt._spill
+
+    def test_GB_spill_result(self):
+        self.pt.memory_limit = 1
+        self.pt.materialize()
+        self.pt.yaxis_order = ['office']
+        eq_([a for a in self.pt.result], [
+            ['office', u'metric', 'city', u'1', u'2', u'3', u'4'],
+            [u'1st', u'Sales', None, u'6', u'250', u'9011', u'1.5'],
+            [u'1st', u'Customers', None, u'1', u'2', u'2', u'1'],
+            [u'2nd', u'Sales', None, u'66', None, None, None],
+            [u'2nd', u'Customers', None, u'3', None, None, None]])
+        self.pt.dematerialize()
+        eq_(self.pt._cube_runs, [])
+
+    def test_GC_not_materialized(self):
+        self.pt.dematerialize()
+        assert_raises(PivotTableError, getattr, self.pt, 'result')
+
+    def test_GD_coresult(self):
+        self.pt.materialize()
+        self.reference.materialize()
+        for order in [['office', 'city'], ['city'], []]:
+            self.pt.yaxis_order = self.reference.yaxis_order = order
+            eq_([r for b in self.pt.coresult(chunk_size=1) for r in b],
+                [a for a in self.reference.result])
+
+class Driver(object):
+    """DB-API connection wrapper that records what its cursors do"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+        self.closed = []
+
+    def cursor(self):
+        driver, cursor = self, self.connection.cursor()
+        class Cursor(object):
+            def execute(self, *args):
+                driver.executed.append(args)
+                return cursor.execute(*args)
+            def fetchmany(self, size):
+                return cursor.fetchmany(size)
+            def close(self):
+                driver.closed.append(True)
+                cursor.close()
+        return Cursor()
+
+class TestPivot_H(object):
+
+    connection = sqlite3.connect(':memory:')
+    connection.execute('create table sales (city text, office text, '
+                       'month integer, sales integer)')
+    connection.executemany('insert into sales values (?, ?, ?, ?)',
+                           [(o.city, o.office, o.month, o.sales)
+                            for o in SALES])
+    driver = Driver(connection)
+
+    pt = PivotTable()
+    pt.xaxis = "month"
+    pt.yaxis = [
+        {'attr':'city', 'label':u'City', 'aggr':GroupBy},
+        {'attr':'office', 'label':u'Office', 'aggr':GroupBy},
+        {'attr':'sales', 'label':u'Sales', 'aggr':Sum}]
+    pt.yaxis_order = ['office', 'city']
+
+    reference = PivotTable()
+    reference.rows = SALES
+    reference.xaxis = "month"
+    reference.yaxis = list(pt.yaxis)
+
+    def test_HA_compile(self):
+        eq_(self.pt._compile_sql('sales', ['city', 'office'],
+                                 self.pt.yaxis[2:]),
+            'SELECT "city", "office", "month", SUM("sales") FROM sales '
+            'GROUP BY "city", "office", "month" '
+            'ORDER BY "office", "city", "month"')
+
+    def test_HB_pushdown(self):
+        self.pt.materialize_sql(self.connection, 'sales')
+        self.reference.materialize()
+        for order in [['office', 'city'], ['city'], []]:
+            self.pt.yaxis_order = self.reference.yaxis_order = order
+            eq_([a for a in self.pt.result],
+                [a for a in self.reference.result])
+
+    def test_HC_subquery(self):
+        self.pt.yaxis += [
+            {'attr':'sales', 'label':u'Tickets', 'aggr':Count},
+            {'attr':'sales', 'label':u'Smallest', 'aggr':Min},
+            {'attr':'sales', 'label':u'Largest', 'aggr':Max}]
+        self.pt.materialize_sql(self.connection, 'select * from sales where '
+                                'city = ?', (u'North City',))
+        self.pt.yaxis_order = ['city']
+        eq_([a for a in self.pt.result], [
+            ['city', u'metric', 'office', u'1', u'3'],
+            [u'North City', u'Sales', None, u'60', u'0'],
+            [u'North City', u'Tickets', None, u'3', u'0'],
+            [u'North City', u'Smallest', None, u'6', None],
+            [u'North City', u'Largest', None, u'34', None]])
+
+    def test_HD_not_pushable(self):
+        self.pt.yaxis.append(
+            {'attr':'sales', 'label':u'Median', 'aggr':Quantile})
+        assert_raises(PivotTableError, self.pt.materialize_sql,
+                      self.connection, 'sales')
+        self.pt.yaxis.pop()
+
+    def test_HE_errors(self):
+        assert_raises(PivotTableError, self.pt.materialize_sql,
+                      self.connection, '  ')
+        assert_raises(sqlite3.OperationalError, self.pt.materialize_sql,
+                      self.driver, 'missing_table')
+        eq_(self.driver.closed, [True])
+
+    def test_HF_driver(self):
+        # no params: format style drivers must not see the % in the source
+        self.pt.yaxis_order = ['city']
+        self.pt.materialize_sql(self.driver, "select * from sales where "
+                                "city like '%City'")
+        eq_(self.driver.executed[-1][1:], ())
+        self.pt.materialize_sql(self.driver, 'sales', ())
+        eq_(self.driver.executed[-1][1:], ((),))
+        self.pt.sql_quote = '`'
+        self.pt.materialize_sql(self.driver, 'sales')
+        assert self.driver.executed[-1][0].startswith(
+            'SELECT `city`, `office`, `month`, SUM(`sales`)')
+        del self.pt.sql_quote
+        eq_([a for a in self.pt.result][1][3:6], [u'60', None, u'0'])
+
+class TestPivot_I(object):
+
+    pt = PivotTable()
+    pt.xaxis = "month"
+    pt.yaxis = [
+        {'attr':'city', 'label':u'City', 'aggr':GroupBy},
+        {'attr':'sales', 'label':u'Sales', 'aggr':Sum}]
+    pt.yaxis_order = ['city']
+
+    other = PivotTable()
+    other.xaxis = "month"
+    other.yaxis = pt.yaxis
+    other.yaxis_order = ['city']
+
+    reference = PivotTable()
+    reference.rows = SALES
+    reference.xaxis = "month"
+    reference.yaxis = pt.yaxis
+    reference.yaxis_order = ['city']
+
+    expected = [
+        ['city', u'metric', u'1', u'2', u'3', u'4'],
+        [u'North City', u'Sales', u'60', None, u'0', None],
+        [u'South City', u'Sales', None, None, u'9011', u'1.5'],
+        [u'West City', u'Sales', u'12', u'250', None, None]]
+
+    def test_IA_feed(self):
+        self.pt.feed(SALES[:4])
+        self.pt.feed(iter(SALES[4:]))
+        self.reference.materialize()
+        eq_([a for a in self.pt.result], [a for a in self.reference.result])
+        eq_([a for a in self.pt.result], self.expected)
+
+    def test_IB_cofeed(self):
+        self.pt.dematerialize()
+        tasks = [self.pt.cofeed(iter(SALES), chunk_size=4),
+                 self.other.cofeed(iter(SALES), chunk_size=5)]
+        progress = []
+        # round robin, the way a cooperative scheduler would do it
+        while tasks:
+            for t in list(tasks):
+                try:
+                    progress.append(t.next())
+                except StopIteration:
+                    tasks.remove(t)
+        eq_(progress, [4, 5, 8, 9, 9])
+        eq_([a for a in self.pt.result], self.expected)
+        eq_([a for a in self.other.result], self.expected)
+
+    def test_IC_coresult(self):
+        tasks = [(self.pt.coresult(chunk_size=2), []),
+                 (self.other.coresult(chunk_size=3), [])]
+        running = list(tasks)
+        while running:
+            for t, batches in list(running):
+                try:
+                    batches.append(t.next())
+                except StopIteration:
+                    running.remove((t, batches))
+        for (t, batches), size in zip(tasks, [2, 3]):
+            eq_([r for b in batches for r in b], self.expected)
+            # control went back to the scheduler before any data row
+            assert [] in batches, batches
+            assert max([len(b) for b in batches]) <= size, batches
+        # not materialized
+        assert_raises(PivotTableError, PivotTable().coresult().next)
+
+class Strict(GenericObject):
+    """Fail when anything but month is read from objects out of 2..3"""
+
+    def __getattribute__(self, name):
+        if name not in ('month', '__dict__') and \
+           object.__getattribute__(self, 'month') not in (2, 3):
+            raise TestError(u'should have been skipped')
+        return object.__getattribute__(self, name)
+
+class TestPivot_J(object):
+
+    pt = PivotTable()
+    pt.rows = SALES
+    pt.xaxis = "month"
+    pt.yaxis = [
+        {'attr':'city', 'label':u'City', 'aggr':GroupBy},
+        {'attr':'sales', 'label':u'Sales', 'aggr':Sum}]
+    pt.yaxis_order = ['city']
+    pt.where = {'city':lambda c: c != u'South City'}
+    pt.xaxis_range = (2, 3)
+
+    expected = [
+        ['city', u'metric', u'2', u'3'],
+        [u'North City', u'Sales', None, u'0'],
+        [u'West City', u'Sales', u'250', None]]
+
+    def test_JA_where(self):
+        eq_(self.pt.headers, ['city', u'metric', 2, 3])
+        # the default result keeps the last value of every cell
+        eq_([a for a in self.pt.result], [
+            ['city', u'metric', u'2', u'3'],
+            [u'North City', u'Sales', None, None],
+            [u'West City', u'Sales', u'5', None]])
+        self.pt.materialize()
+        eq_([a for a in self.pt.result], self.expected)
+        self.pt.dematerialize()
+
+    def test_JB_presorted(self):
+        # bisecting reads the xaxis of a few objects outside xaxis_range,
+        # but nothing else
+        rows = [Strict(**o.__dict__) for o in SALES]
+        rows.sort(key=lambda o: o.month)
+        self.pt.rows = rows
+        self.pt.xaxis_presorted = True
+        self.pt.materialize()
+        eq_([a for a in self.pt.result], self.expected)
+        self.pt.dematerialize()
+        self.pt.xaxis_presorted = False
+        self.pt.rows = SALES
+
+    def test_JC_sql(self):
+        self.pt.materialize_sql(TestPivot_H.connection, 'sales')
+        eq_([a for a in self.pt.result], self.expected)
+        self.pt.dematerialize()
+
+    def test_JD_wrong_where(self):
+        self.pt.where = {'sales':lambda s: s > 10}
+        assert_raises(PivotTableError, getattr, self.pt, 'headers')
+        assert_raises(PivotTableError, self.pt.materialize)
+
+    def test_JE_stale_conditions(self):
+        self.pt.where = {'city':lambda c: c != u'South City'}
+        self.pt.materialize()
+        self.pt.xaxis_range = (1, 3)
+        assert_raises(PivotTableError, getattr, self.pt, 'headers')
+        assert_raises(PivotTableError, self.pt.feed, SALES)
+        self.pt.xaxis_range = (2, 3)
+        self.pt.where['city'] = lambda c: True
+        assert_raises(PivotTableError, getattr, self.pt, 'headers')
+        self.pt.materialize()
+        eq_(self.pt.headers, ['city', u'metric', 2, 3])
+        self.pt.dematerialize()
+
+    def test_JF_no_yaxis(self):
+        pt = PivotTable()
+        pt.rows = SALES
+        pt.xaxis = "month"
+        pt.where = {'month':lambda m: m > 1}
+        assert_raises(PivotTableError, getattr, pt, 'headers')
+
+class TestPivot_K(object):
+
+    pt = PivotTable()
+    pt.rows = SALES
+    pt.xaxis = "month"
+    pt.yaxis = [
+        {'attr':'city', 'label':u'City', 'aggr':GroupBy},
+        {'attr':'sales', 'label':u'Sales', 'aggr':Sum},
+        {'attr':'sales', 'label':u'Tickets', 'aggr':Count},
+        {'attr':'sales', 'label':u'Smallest', 'aggr':Min},
+        {'attr':'rate', 'label':u'Rate', 'aggr':Max},
+        {'attr':'customer', 'label':u'Customers', 'aggr':CountDistinct}]
+    pt.yaxis_order = ['city']
+    pt.memory_limit = 2
+
+    loaded = PivotTable()
+    loaded.xaxis = "month"
+    loaded.yaxis = pt.yaxis
+    loaded.yaxis_order = ['city']
+
+    def setup(self):
+        self.path = tempfile.mktemp()
+
+    def teardown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_KA_snapshot(self):
+        self.pt.materialize()
+        self.pt.save_snapshot(self.path, u'2011-02-01')
+        eq_(self.loaded.load_snapshot(self.path, u'2011-02-01'), True)
+        for order in [['city'], []]:
+            self.pt.yaxis_order = self.loaded.yaxis_order = order
+            eq_([a for a in self.loaded.result], [a for a in self.pt.result])
+        eq_([a for a in self.loaded.result][1:], [
+            [u'Sales', None, u'72', u'250', u'9011', u'1.5'],
+            [u'Tickets', None, u'4', u'2', u'1', u'1'],
+            [u'Smallest', None, u'6', u'5', u'9011', u'1.5'],
+            [u'Rate', None, u'0.75', u'0.5', u'1.0', u'0.5'],
+            [u'Customers', None, u'3', u'2', u'2', u'1']])
+
+    def test_KB_stale_snapshot(self):
+        self.pt.save_snapshot(self.path, 1)
+        eq_(self.loaded.load_snapshot(self.path, 2), False)
+        other = PivotTable()
+        other.xaxis = "month"
+        other.yaxis = self.pt.yaxis[:2]
+        eq_(other.load_snapshot(self.path, 1), False)
+        eq_(other._cube, None)
+        yaxis = self.pt.yaxis
+        self.pt.yaxis = yaxis[:2]
+        assert_raises(PivotTableError, self.pt.save_snapshot, self.path, 1)
+        self.pt.yaxis = yaxis
+        f = open(self.path, 'wb')
+        f.write('not a snapshot'*10)
+        f.close()
+        assert_raises(PivotTableError, self.pt.load_snapshot, self.path, 1)
+
+    def test_KC_truncated(self):
+        version = u'a\xf1o 2011'
+        self.pt.save_snapshot(self.path, version)
+        eq_(self.loaded.load_snapshot(self.path, version), True)
+        eq_(self.loaded.load_snapshot(self.path, u'a\xf1o 2012'), False)
+        data = open(self.path, 'rb').read()
+        f = open(self.path, 'wb')
+        f.write(data[:-8])
+        f.close()
+        assert_raises(PivotTableError, self.loaded.load_snapshot, self.path,
+                      version)
+        # the cells loaded before are still there
+        eq_([a for a in self.loaded.result][1][2], u'72')
+
+    def test_KD_conditions(self):
+        self.pt.xaxis_range = (2, 3)
+        assert_raises(PivotTableError, self.pt.save_snapshot, self.path, 1)
+        self.pt.materialize()
+        self.pt.save_snapshot(self.path, 1)
+        eq_(self.loaded.load_snapshot(self.path, 1), False)
+        self.pt.xaxis_range = None
+        self.pt.where = {'city':lambda c: c != u'South City'}
+        self.pt.materialize()
+        assert_raises(PivotTableError, self.pt.save_snapshot, self.path, 1)
+        self.pt.where = None
+
+    def test_KE_spilled(self):
+        # cells are saved and loaded a few at a time, and the loaded ones
+        # spill like materialized ones do
+        pivottable.SNAPSHOT_CHUNK = 3
+        self.pt.materialize()
+        assert self.pt._cube_runs
+        self.pt.save_snapshot(self.path, 1)
+        self.loaded.memory_limit = 2
+        eq_(self.loaded.load_snapshot(self.path, 1), True)
+        assert self.loaded._cube_runs
+        assert len(self.loaded._cube) <= 2
+        for order in [['city'], []]:
+            self.pt.yaxis_order = self.loaded.yaxis_order = order
+            eq_([a for a in self.loaded.result], [a for a in self.pt.result])
+        del self.loaded.memory_limit
+        pivottable.SNAPSHOT_CHUNK = 1000
+
+    def test_KF_failed_save(self):
+        # the snapshot cannot replace a directory
+        path = tempfile.mkdtemp()
+        assert_raises(OSError, self.pt.save_snapshot, path, 1)
+        eq_(os.path.exists('%s.%d.tmp' % (path, os.getpid())), False)
+        os.rmdir(path)
+
+class TestPivot_L(object):
+
+    pt = PivotTable()
+    # equal but distinct string objects, as a database driver returns them
+    pt.rows = [GenericObject(**{'city':u''.join(city), 'month':month,
+                                'sales':sales})
+               for city, month, sales in [
+                   ((u'West', u' City'), 2, 245),
+                   ((u'North', u' City'), 1, 34),
+                   ((u'West', u' City'), 1, 12),
+                   ((u'North', u' City'), 2, 6)]]
+    pt.xaxis = "month"
+    pt.yaxis = [
+        {'attr':'city', 'label':u'City', 'aggr':GroupBy},
+        {'attr':'sales', 'label':u'Sales', 'aggr':Sum}]
+    pt.yaxis_order = ['city']
+
+    def test_LA_encoding(self):
+        self.pt.materialize()
+        eq_(self.pt._cube_values, [[u'West City', u'North City'], [2, 1]])
+        eq_(sorted(self.pt._cube.keys()), [((0,), 0), ((0,), 1), ((1,), 0),
+                                           ((1,), 1)])
+        result = [a for a in self.pt.result]
+        eq_(result, [
+            ['city', u'metric', u'1', u'2'],
+            [u'North City', u'Sales', u'34', u'6'],
+            [u'West City', u'Sales', u'12', u'245']])
+        # every row shares the single decoded copy of its key
+        assert result[1][0] is self.pt._cube_values[0][1]